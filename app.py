@@ -1,29 +1,116 @@
 import streamlit as st
+import orjson
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
 
-from db_utils import csv_to_sqlite, get_db_schema, run_sql
-from llm_utils import build_prompt, generate_query_plan
+from db_utils import chunks_to_sqlite, data_version, get_db_schema, run_sql
+from llm_utils import generate_query_plan
 from viz_utils import execute_visualization
 from logger_config import get_logger
 
 logger = get_logger(__name__)
 
+# Bytes parsed and written per step, bounding memory regardless of file size
+_CSV_BLOCK_SIZE = 16 << 20
+
+# Rows per chunk when falling back to pandas' per-chunk type inference
+_CSV_CHUNK_ROWS = 100_000
+
+# Blank and NA-like cells become NULL, quoted or not, as with pd.read_csv
+_CSV_CONVERT_OPTIONS = pacsv.ConvertOptions(
+    strings_can_be_null=True, quoted_strings_can_be_null=True
+)
+
+
+def _arrow_chunks(uploaded_file, encoding):
+    read_options = pacsv.ReadOptions(
+        block_size=_CSV_BLOCK_SIZE, use_threads=True, encoding=encoding
+    )
+    reader = pacsv.open_csv(
+        uploaded_file, read_options=read_options, convert_options=_CSV_CONVERT_OPTIONS
+    )
+
+    # Arrow infers non-UTF-8 text columns as binary instead of failing
+    if encoding == "utf8" and any(pa.types.is_binary(f.type) for f in reader.schema):
+        raise UnicodeDecodeError("utf-8", b"", 0, 0, "CSV contains non-UTF-8 text")
+
+    try:
+        for batch in reader:
+            yield _dates_and_times_to_text(batch).to_pandas()
+    except pa.ArrowInvalid as e:
+        # Invalid UTF-8 in a later block surfaces as a string conversion error
+        if "UTF8" in str(e):
+            raise UnicodeDecodeError("utf-8", b"", 0, 0, str(e)) from e
+        raise
+
+
+def _dates_and_times_to_text(batch):
+    # Arrow infers date32/time32 columns, which convert to datetime.date and
+    # datetime.time objects sqlite3 cannot bind (or only through its deprecated
+    # adapter); keep the ISO text pd.read_csv would have stored
+    columns = [
+        col.cast(pa.string())
+        if pa.types.is_date(field.type) or pa.types.is_time(field.type) else col
+        for field, col in zip(batch.schema, batch.columns)
+    ]
+    return pa.RecordBatch.from_arrays(columns, names=batch.schema.names)
+
+
+def _with_preview(chunks, preview):
+    for chunk in chunks:
+        if not preview:
+            preview.append(chunk.head())
+        yield chunk
+
+
+def load_csv(uploaded_file, encoding="utf8"):
+    """Stream the upload into SQLite, replacing the table atomically; return a preview and row count."""
+    preview = []
+    try:
+        total_rows = chunks_to_sqlite(
+            _with_preview(_arrow_chunks(uploaded_file, encoding), preview)
+        )
+    except pa.ArrowInvalid as e:
+        # Arrow fixes column types from the first block, so e.g. text showing up
+        # later in a numeric column fails; pandas infers types per chunk instead
+        logger.warning("Arrow CSV reader failed, falling back to pandas: %s", e)
+        uploaded_file.seek(0)
+        preview.clear()
+        chunks = pd.read_csv(uploaded_file, encoding=encoding, chunksize=_CSV_CHUNK_ROWS)
+        total_rows = chunks_to_sqlite(_with_preview(chunks, preview))
+
+    return (preview[0] if preview else pd.DataFrame()), total_rows
+
+
 st.title("Chat with your CSV")
 
 uploaded_file = st.file_uploader("Upload CSV", type=["csv"])
 
 if uploaded_file:
-    try:
-        df = pd.read_csv(uploaded_file)
-        logger.info("File uploaded: shape=%s", df.shape)
-    except UnicodeDecodeError:
-        df = pd.read_csv(uploaded_file, encoding="latin1")
-        logger.info("File uploaded with latin1 encoding: shape=%s", df.shape)
+    # Widget reruns keep the same upload, so it is only re-ingested when the
+    # file changes or another session has since loaded its own CSV into the
+    # shared database; otherwise cached query results stay valid.
+    if (
+        st.session_state.get("loaded_file_id") != uploaded_file.file_id
+        or st.session_state.get("loaded_data_version") != data_version()
+    ):
+        uploaded_file.seek(0)
+        try:
+            preview, total_rows = load_csv(uploaded_file)
+            logger.info("File uploaded: rows=%d", total_rows)
+        except UnicodeDecodeError:
+            uploaded_file.seek(0)
+            preview, total_rows = load_csv(uploaded_file, encoding="latin1")
+            logger.info("File uploaded with latin1 encoding: rows=%d", total_rows)
+
+        st.session_state["loaded_file_id"] = uploaded_file.file_id
+        st.session_state["loaded_data_version"] = data_version()
+        st.session_state["csv_preview"] = preview
 
     st.subheader("Preview of CSV")
-    st.dataframe(df.head())
+    st.dataframe(st.session_state["csv_preview"])
 
-    csv_to_sqlite(df)
     st.success("CSV saved to database")
 
     st.subheader("Detected SQL Schema")
@@ -33,22 +120,23 @@ if uploaded_file:
     user_question = st.text_input("Ask a question about your data")
 
     if user_question:
-        # 1️⃣ Build prompt
-        prompt = build_prompt(schema, user_question)
-
-        # 2️⃣ Ask LLM (SQL + optional chart metadata)
-        plan = generate_query_plan(prompt)
+        # 1️⃣ Ask LLM (SQL + optional chart metadata); repeats are served from cache
+        # and widget reruns for the same question reuse the last plan outright
+        plan_key = (schema, user_question)
+        if st.session_state.get("last_plan_key") != plan_key:
+            st.session_state["last_plan"] = generate_query_plan(schema, user_question)
+            st.session_state["last_plan_key"] = plan_key
+        plan = dict(st.session_state["last_plan"])
 
         #DEBUG: Inspect what the LLM actually returned
         st.subheader("LLM Raw Plan")
-        st.json(plan)
+        st.json(orjson.dumps(plan).decode())
 
         # Extract SQL with validation
         if isinstance(plan, str):
             # If plan is still a string, try to parse it
-            import json
             try:
-                plan = json.loads(plan)
+                plan = orjson.loads(plan)
             except:
                 # Fall back to treating it as raw SQL
                 plan = {"sql": plan}
@@ -66,7 +154,7 @@ if uploaded_file:
         st.subheader("Generated SQL")
         st.code(sql)
 
-        # 3️⃣ Execute SQL (UNCHANGED logic)
+        # 2️⃣ Execute SQL (UNCHANGED logic)
         cols, rows = run_sql(sql)
         df_result = pd.DataFrame(rows, columns=cols)
 
@@ -74,7 +162,7 @@ if uploaded_file:
 
         st.subheader("Results")
 
-        # 4️⃣ Execute visualization OR show table
+        # 3️⃣ Execute visualization OR show table
         if "viz_code" in plan:
             st.write("Result DataFrame:")
             st.dataframe(df_result)
@@ -1,86 +1,248 @@
+import itertools
+import logging
+import re
 import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
 import pandas as pd
 from logger_config import get_logger
 
 logger = get_logger(__name__)
 
+# One long-lived connection per database file, configured once on first use.
+# Streamlit runs every session in its own thread, so all use of the shared
+# connections is serialized through _DB_LOCK (see _connection).
+_CONNECTIONS = {}
+_DB_LOCK = threading.RLock()
+
+
+def _get_conn(db_name):
+    conn = _CONNECTIONS.get(db_name)
+    if conn is None:
+        logger.debug("Opening SQLite connection | db=%s", db_name)
+        conn = sqlite3.connect(db_name, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        conn.execute("PRAGMA temp_store=MEMORY;")
+        # Read path: serve pages from a 256 MB memory map and a 64 MB page cache
+        conn.execute("PRAGMA mmap_size=268435456;")
+        conn.execute("PRAGMA cache_size=-65536;")
+        _CONNECTIONS[db_name] = conn
+    return conn
+
+
+@contextmanager
+def _connection(db_name):
+    with _DB_LOCK:
+        yield _get_conn(db_name)
+
+
+@contextmanager
+def _transaction(db_name):
+    # BEGIN..COMMIT under the lock; rolled back before the lock is released
+    with _connection(db_name) as conn:
+        conn.execute("BEGIN;")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK;")
+            raise
+        conn.execute("COMMIT;")
+
+
+# Any run of leading "--" line comments and /* */ block comments
+_LEADING_COMMENTS_RE = re.compile(r"^(?:\s*(?:--[^\n]*(?:\n|$)|/\*.*?\*/))+", re.DOTALL)
+
+# Characters in CSV headers replaced with "_" to form column names
+_COLUMN_SEPARATORS_RE = re.compile(r"[ \-]")
+
+# Query results keyed by (db, SQL text, data version); chunks_to_sqlite bumps
+# the version so results from a previous upload are never served.
+_SQL_CACHE_MAXSIZE = 128
+_SQL_CACHE = OrderedDict()
+_SQL_CACHE_LOCK = threading.Lock()
+_SQL_CACHE_VERSION = 0
+
+# SQLite's default cap on terms in one compound SELECT (SQLITE_MAX_COMPOUND_SELECT)
+_MAX_COMPOUND_SELECT = 500
+
+# Rows per executemany call during bulk load
+_INSERT_BATCH_ROWS = 50_000
+
+
+# SQLite column affinity per numpy dtype kind; anything else is stored as TEXT
+_SQLITE_TYPES = {
+    "b": "INTEGER",
+    "i": "INTEGER",
+    "u": "INTEGER",
+    "f": "REAL",
+    "M": "TEXT",
+}
+
+
+def _sqlite_type(dtype):
+    return _SQLITE_TYPES.get(dtype.kind, "TEXT")
+
+
+def _datetimes_to_text(df):
+    # sqlite3 cannot bind NaT and its datetime adapter is deprecated, so store
+    # timestamps as isoformat(" ") text, keeping fractional seconds and offsets
+    datetime_cols = [i for i, dtype in enumerate(df.dtypes) if dtype.kind == "M"]
+    if not datetime_cols:
+        return df
+
+    df = df.copy(deep=False)
+    for i in datetime_cols:
+        col = df.iloc[:, i]
+        text = col.map(lambda t: t.isoformat(" "), na_action="ignore").astype(object)
+        df.isetitem(i, text.where(col.notna(), None))
+    return df
+
+
+def _clean_columns(columns):
+    # Lowercase, "_" for separators, and name blank or repeated headers the way
+    # pd.read_csv does ("Unnamed: 0", "a.1"); repeats are checked after
+    # lowercasing since SQLite column names are case-insensitive
+    names = []
+    seen = set()
+    for i, col in enumerate(columns):
+        name = _COLUMN_SEPARATORS_RE.sub("_", (str(col).strip() or f"Unnamed: {i}").lower())
+        base, n = name, 0
+        while name in seen:
+            n += 1
+            name = f"{base}.{n}"
+        seen.add(name)
+        names.append(name)
+    return names
+
+
+def _quote_ident(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def data_version():
+    """Counter bumped after every successful load; lets callers notice that
+    another session has replaced the shared table."""
+    return _SQL_CACHE_VERSION
+
 
 def csv_to_sqlite(df, db_name="data.db", table_name="data"):
-    logger.info("ENTER csv_to_sqlite")
+    return chunks_to_sqlite([df], db_name, table_name)
+
+
+def chunks_to_sqlite(chunks, db_name="data.db", table_name="data"):
+    """Replace a table with the rows of an iterable of DataFrame chunks.
+
+    The table is created from the first chunk's cleaned columns; later chunks
+    are inserted positionally into a staging table that only replaces the
+    previous table once every chunk is written, so an error while reading a
+    later chunk leaves the previous table untouched.
+    Returns the number of rows written.
+    """
+    global _SQL_CACHE_VERSION
+    logger.info("ENTER chunks_to_sqlite")
 
+    chunks = iter(chunks)
+    df = next(chunks, None)
     if df is None or df.empty:
-        logger.warning("csv_to_sqlite: received empty DataFrame")
-        return
+        logger.warning("chunks_to_sqlite: received empty DataFrame")
+        return 0
 
-    logger.debug("Original columns: %s", list(df.columns))
+    debug = logger.isEnabledFor(logging.DEBUG)
+    if debug:
+        logger.debug("Original columns: %s", list(df.columns))
 
     # Clean column names
-    df.columns = (
-        df.columns
-        .str.strip()
-        .str.lower()
-        .str.replace(" ", "_")
-        .str.replace("-", "_")
-    )
+    df.columns = _clean_columns(df.columns)
+
+    if debug:
+        logger.debug("Cleaned columns: %s", list(df.columns))
 
-    logger.debug("Cleaned columns: %s", list(df.columns))
     logger.info(
-        "Writing DataFrame to SQLite | db=%s table=%s rows=%d cols=%d",
-        db_name, table_name, df.shape[0], df.shape[1]
+        "Writing DataFrame chunks to SQLite | db=%s table=%s cols=%d",
+        db_name, table_name, df.shape[1]
     )
 
-    logger.debug("Opening SQLite connection")
-    conn = sqlite3.connect(db_name)
+    column_defs = ", ".join(
+        f"{_quote_ident(col)} {_sqlite_type(dtype)}"
+        for col, dtype in df.dtypes.items()
+    )
+    placeholders = ", ".join("?" * df.shape[1])
+    # Rows go into a per-thread staging table that replaces the old one at the
+    # end. Chunks are parsed outside _DB_LOCK, so other sessions keep querying
+    # the previous table during a long upload; the lock is held only for each
+    # chunk's inserts and for the final swap.
+    staging = f"{table_name}__staging_{threading.get_ident()}"
+    insert_sql = f"INSERT INTO {staging} VALUES ({placeholders})"
+    total_rows = 0
 
     try:
-        logger.debug("Calling DataFrame.to_sql(if_exists='replace')")
-        df.to_sql(
-            table_name,
-            conn,
-            if_exists="replace",
-            index=False
+        with _connection(db_name) as conn:
+            conn.execute(f"DROP TABLE IF EXISTS {staging}")
+            conn.execute(f"CREATE TABLE {staging} ({column_defs})")
+
+        for chunk in itertools.chain([df], chunks):
+            rows_df = _datetimes_to_text(chunk)
+            with _transaction(db_name) as conn:
+                for start in range(0, len(rows_df), _INSERT_BATCH_ROWS):
+                    batch = rows_df.iloc[start:start + _INSERT_BATCH_ROWS]
+                    conn.executemany(insert_sql, batch.itertuples(index=False, name=None))
+            total_rows += len(chunk)
+
+        with _transaction(db_name) as conn:
+            conn.execute(f"DROP TABLE IF EXISTS {table_name}")
+            conn.execute(f"ALTER TABLE {staging} RENAME TO {table_name}")
+            _SQL_CACHE_VERSION += 1
+        logger.info(
+            "SUCCESS chunks_to_sqlite: table '%s' written | rows=%d",
+            table_name, total_rows
         )
-        logger.info("SUCCESS csv_to_sqlite: table '%s' written", table_name)
 
     except Exception as e:
-        logger.exception(
-            "FAILED csv_to_sqlite | db=%s table=%s error=%s",
-            db_name, table_name, e
-        )
+        with _connection(db_name) as conn:
+            conn.execute(f"DROP TABLE IF EXISTS {staging}")
+        if isinstance(e, sqlite3.Error):
+            logger.exception(
+                "FAILED chunks_to_sqlite | db=%s table=%s error=%s",
+                db_name, table_name, e
+            )
+        else:
+            # Errors from the chunk source (bad encoding, unparsable rows) are
+            # expected; the caller decides whether to retry with another reader.
+            logger.warning(
+                "chunks_to_sqlite: reading chunks failed, table unchanged | db=%s table=%s error=%s",
+                db_name, table_name, e
+            )
         raise
 
     finally:
-        logger.debug("Closing SQLite connection")
-        conn.close()
-        logger.info("EXIT csv_to_sqlite")
+        logger.info("EXIT chunks_to_sqlite")
+
+    return total_rows
 
 
 def get_db_schema(db_name="data.db", table_name="data"):
     logger.info("ENTER get_db_schema | db=%s table=%s", db_name, table_name)
 
-    conn = sqlite3.connect(db_name)
-    logger.debug("SQLite connection opened")
-
-    try:
-        cursor = conn.cursor()
-        sql = f"PRAGMA table_info({table_name});"
+    with _connection(db_name) as conn:
+        try:
+            cursor = conn.cursor()
+            sql = f"PRAGMA table_info({table_name});"
 
-        logger.debug("Executing SQL: %s", sql)
-        cursor.execute(sql)
+            logger.debug("Executing SQL: %s", sql)
+            cursor.execute(sql)
 
-        columns = cursor.fetchall()
-        logger.debug("Raw schema rows: %s", columns)
+            columns = cursor.fetchall()
+            logger.debug("Raw schema rows: %s", columns)
 
-    except Exception as e:
-        logger.exception(
-            "FAILED get_db_schema | db=%s table=%s error=%s",
-            db_name, table_name, e
-        )
-        raise
-
-    finally:
-        logger.debug("Closing SQLite connection")
-        conn.close()
+        except Exception as e:
+            logger.exception(
+                "FAILED get_db_schema | db=%s table=%s error=%s",
+                db_name, table_name, e
+            )
+            raise
 
     schema = [f"- {col[1]} ({col[2]})" for col in columns]
     result = "\n".join(schema)
@@ -96,45 +258,58 @@ def run_sql(sql, db_name="data.db"):
     logger.debug("Received SQL: %s", sql_clean)
 
     # Check if it's a SELECT query (handle comments and whitespace)
-    sql_lower = sql_clean.lower()
     # Remove leading SQL comments (-- or /* */)
-    while sql_lower.startswith("--"):
-        sql_lower = "\n".join(sql_lower.split("\n")[1:]).lstrip()
-    if sql_lower.startswith("/*"):
-        sql_lower = sql_lower.split("*/", 1)[1].lstrip().lower()
-    
+    sql_lower = _LEADING_COMMENTS_RE.sub("", sql_clean).lstrip().lower()
+
     if not sql_lower.startswith("select"):
         logger.warning("Rejected non-SELECT SQL: %s", sql_clean[:100])
         raise ValueError("Only SELECT queries are allowed")
 
-    conn = sqlite3.connect(db_name)
-    logger.debug("SQLite connection opened")
+    cache_key = (db_name, sql_clean, _SQL_CACHE_VERSION)
+    with _SQL_CACHE_LOCK:
+        cached = _SQL_CACHE.get(cache_key)
+        if cached is not None:
+            _SQL_CACHE.move_to_end(cache_key)
+    if cached is not None:
+        logger.info("Query cache hit | rows=%d cols=%d", len(cached[1]), len(cached[0]))
+        logger.info("EXIT run_sql")
+        return cached
 
     try:
-        cursor = conn.cursor()
+        with _connection(db_name) as conn:
+            cursor = conn.cursor()
 
-        logger.debug("EXPLAIN QUERY PLAN for SQL")
-        cursor.execute(f"EXPLAIN QUERY PLAN {sql_clean}")
-        plan = cursor.fetchall()
-        logger.debug("Query plan: %s", plan)
+            # The extra parse + plan is only worth paying for when it gets logged
+            if logger.isEnabledFor(logging.DEBUG):
+                cursor.execute(f"EXPLAIN QUERY PLAN {sql_clean}")
+                plan = cursor.fetchall()
+                logger.debug("Query plan: %s", plan)
 
-        logger.debug("Executing SQL query")
-        cursor.execute(sql_clean)
+            logger.debug("Executing SQL query")
+            cursor.execute(sql_clean)
 
-        logger.debug("Fetching all rows")
-        rows = cursor.fetchall()
+            logger.debug("Fetching all rows")
+            rows = cursor.fetchall()
 
-        col_names = [desc[0] for desc in cursor.description]
+            col_names = [desc[0] for desc in cursor.description]
 
-        logger.info(
-            "Query SUCCESS | rows=%d cols=%d",
-            len(rows), len(col_names)
-        )
+            logger.info(
+                "Query SUCCESS | rows=%d cols=%d",
+                len(rows), len(col_names)
+            )
+
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Column names: %s", col_names)
+                logger.debug("First 5 rows: %s", rows[:5])
 
-        logger.debug("Column names: %s", col_names)
-        logger.debug("First 5 rows: %s", rows[:5])
+        # Tuples, so a caller cannot alter what later cache hits return
+        result = (tuple(col_names), tuple(rows))
 
-        return col_names, rows
+        with _SQL_CACHE_LOCK:
+            _SQL_CACHE[cache_key] = result
+            if len(_SQL_CACHE) > _SQL_CACHE_MAXSIZE:
+                _SQL_CACHE.popitem(last=False)
+        return result
 
     except Exception as e:
         logger.exception(
@@ -144,19 +319,34 @@ def run_sql(sql, db_name="data.db"):
         raise
 
     finally:
-        logger.debug("Closing SQLite connection")
-        conn.close()
         logger.info("EXIT run_sql")
 
 
+def _inspect_column(cur, table_name, col, sample_limit):
+    q = _quote_ident(col)
+    try:
+        # distinct count
+        cur.execute(f"SELECT COUNT(DISTINCT {q}) FROM {table_name}")
+        distinct = cur.fetchone()[0]
+
+        # sample non-null values
+        cur.execute(f"SELECT {q} FROM {table_name} WHERE {q} IS NOT NULL LIMIT {sample_limit}")
+        samples = [r[0] for r in cur.fetchall()]
+
+        logger.debug("debug_table col=%s distinct=%s samples=%s", col, distinct, samples)
+        return {"distinct_count": distinct, "sample_values": samples}
+    except Exception as e:
+        logger.exception("debug_table: failed to inspect column %s: %s", col, e)
+        return {"error": str(e)}
+
+
 def debug_table(table_name="data", db_name="data.db", sample_limit: int = 5):
     """Return diagnostics for a table: row count, columns, distinct counts, and sample values.
 
     Useful for understanding why a WHERE clause may match nothing.
     """
     logger.info("ENTER debug_table | db=%s table=%s", db_name, table_name)
-    conn = sqlite3.connect(db_name)
-    try:
+    with _connection(db_name) as conn:
         cur = conn.cursor()
 
         # total rows
@@ -172,27 +362,41 @@ def debug_table(table_name="data", db_name="data.db", sample_limit: int = 5):
 
         diagnostics = {"total_rows": total, "columns": {}}
 
-        for col in col_names:
-            try:
-                # distinct count
-                cur.execute(f"SELECT COUNT(DISTINCT {col}) FROM {table_name}")
-                distinct = cur.fetchone()[0]
-
-                # sample non-null values
-                cur.execute(f"SELECT {col} FROM {table_name} WHERE {col} IS NOT NULL LIMIT {sample_limit}")
-                samples = [r[0] for r in cur.fetchall()]
-
+        if not col_names:
+            logger.info("EXIT debug_table")
+            return diagnostics
+
+        quoted = [_quote_ident(col) for col in col_names]
+
+        try:
+            # distinct counts for every column in one table scan
+            distinct_sql = ", ".join(f"COUNT(DISTINCT {q})" for q in quoted)
+            cur.execute(f"SELECT {distinct_sql} FROM {table_name}")
+            distinct_counts = cur.fetchone()
+
+            # sample non-null values for every column; each branch stops after
+            # sample_limit matches inside SQLite
+            samples = [[] for _ in col_names]
+            branches = [
+                f"SELECT {i}, v FROM (SELECT {q} AS v FROM {table_name} "
+                f"WHERE {q} IS NOT NULL LIMIT {sample_limit})"
+                for i, q in enumerate(quoted)
+            ]
+            for start in range(0, len(branches), _MAX_COMPOUND_SELECT):
+                cur.execute(" UNION ALL ".join(branches[start:start + _MAX_COMPOUND_SELECT]))
+                for i, value in cur.fetchall():
+                    samples[i].append(value)
+        except Exception as e:
+            logger.warning("debug_table: fused column queries failed, inspecting columns one by one: %s", e)
+            for col in col_names:
+                diagnostics["columns"][col] = _inspect_column(cur, table_name, col, sample_limit)
+        else:
+            for col, distinct, values in zip(col_names, distinct_counts, samples):
                 diagnostics["columns"][col] = {
                     "distinct_count": distinct,
-                    "sample_values": samples
+                    "sample_values": values
                 }
-                logger.debug("debug_table col=%s distinct=%s samples=%s", col, distinct, samples)
-            except Exception as e:
-                logger.exception("debug_table: failed to inspect column %s: %s", col, e)
-                diagnostics["columns"][col] = {"error": str(e)}
+                logger.debug("debug_table col=%s distinct=%s samples=%s", col, distinct, values)
 
-        logger.info("EXIT debug_table")
-        return diagnostics
-
-    finally:
-        conn.close()
+    logger.info("EXIT debug_table")
+    return diagnostics
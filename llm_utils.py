@@ -1,28 +1,61 @@
-import json
+import hashlib
+import logging
 import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from functools import cache, lru_cache
+import orjson
 from dotenv import load_dotenv
 
 from groq import Groq
 from logger_config import get_logger
 
-# Load environment variables from .env file
-load_dotenv()
-
 logger = get_logger(__name__)
-_GROQ_MODEL = os.getenv("GROQ_MODEL", "llama-3.1-8b-instant")
-_GROQ_CLIENT = Groq(api_key=os.getenv("GROQ_API_KEY"))
 
 
-def build_prompt(schema, user_question):
-    logger.debug("build_prompt called with user_question=%s", user_question)
+# The .env file is read and the HTTP client built on first use, not at import.
+@cache
+def _load_env():
+    # Load environment variables from .env file
+    load_dotenv()
+
+
+@cache
+def _model():
+    _load_env()
+    return os.getenv("GROQ_MODEL", "llama-3.1-8b-instant")
+
+
+@cache
+def _client():
+    _load_env()
+    return Groq(api_key=os.getenv("GROQ_API_KEY"))
+
+
+# Parsed plans keyed by (schema, question, model), so repeated questions skip the LLM.
+_PLAN_CACHE_MAXSIZE = 256
+_PLAN_CACHE = OrderedDict()
+
+# Identical requests already waiting on the LLM; later callers share the Future.
+_IN_FLIGHT = {}
+_IN_FLIGHT_LOCK = threading.Lock()
+
+# Fallback extraction when the LLM response is not valid JSON
+_CODE_BLOCK_RE = re.compile(r"```(?:sql)?([\s\S]*?)```", re.IGNORECASE)
+_SELECT_RE = re.compile(r"(select[\s\S]*)", re.IGNORECASE)
+
+
+# Static instructions go first so the provider can reuse the cached prompt
+# prefix across requests; only the schema and question vary per call.
+SYSTEM_PROMPT = """
+You are a backend service. Return ONLY valid JSON. Never explain. Never use markdown.
 
-    return f"""
 You are an expert SQL and data visualization code generator.
 
 Database: SQLite
-Table: data
-Columns:
-{schema}
+Table: data (columns are listed in the user message)
 
 Output MUST be valid JSON.
 
@@ -105,64 +138,110 @@ OUTPUT RULES (CRITICAL)
 - DO NOT include the word "Here"
 - Output ONLY a valid JSON object
 
-User question:
-{user_question}
-
 Example JSON output when a visualization is required:
-{{
+{
     "sql": "SELECT category AS cat, COUNT(*) * 100.0 / (SELECT COUNT(*) FROM data) AS pct FROM data GROUP BY category;",
-    "viz_code": "import plotly.express as px\\nfig = px.bar(df, x='cat', y='pct', title='Distribution by Category', labels={{'pct': 'Percentage'}})"
-}}
+    "viz_code": "import plotly.express as px\\nfig = px.bar(df, x='cat', y='pct', title='Distribution by Category', labels={'pct': 'Percentage'})"
+}
 
 If no visualization is appropriate, omit "viz_code" entirely.
 """
 
 
+@lru_cache(maxsize=64)
+def build_user_message(schema, user_question):
+    logger.debug("build_user_message called with user_question=%s", user_question)
+
+    return f"""Columns:
+{schema}
+
+User question:
+{user_question}
+"""
+
 
 def generate_sql(prompt):
     logger.info("generate_sql: sending prompt to LLM (truncated)")
     try:
-        response = _GROQ_CLIENT.chat.completions.create(
-            model=_GROQ_MODEL,
+        response = _client().chat.completions.create(
+            model=_model(),
             messages=[{"role": "user", "content": prompt}],
             temperature=0
         )
         sql = response.choices[0].message.content.strip()
-        logger.debug(
-            "generate_sql: llm response (truncated): %s",
-            (sql[:300] + "...") if len(sql) > 300 else sql,
-        )
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "generate_sql: llm response (truncated): %s",
+                (sql[:300] + "...") if len(sql) > 300 else sql,
+            )
         return sql
     except Exception:
         logger.exception("generate_sql: LLM call failed")
         raise
 
 
-import re
-import json
+def _plan_key(schema, user_question):
+    h = hashlib.blake2b(digest_size=16)
+    for part in (schema, user_question, _model()):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
 
-def generate_query_plan(prompt, retry=False):
-    logger.info("generate_query_plan: sending prompt to LLM | retry=%s", retry)
 
-    system_msg = (
-        "You are a backend service. "
-        "Return ONLY valid JSON. "
-        "Never explain. Never use markdown."
-    )
+def generate_query_plan(schema, user_question):
+    key = _plan_key(schema, user_question)
+
+    with _IN_FLIGHT_LOCK:
+        plan = _PLAN_CACHE.get(key)
+        if plan is not None:
+            _PLAN_CACHE.move_to_end(key)
+            logger.info("generate_query_plan: cache hit")
+            return dict(plan)
+
+        future = _IN_FLIGHT.get(key)
+        owner = future is None
+        if owner:
+            future = Future()
+            _IN_FLIGHT[key] = future
+
+    if not owner:
+        logger.info("generate_query_plan: waiting on identical in-flight request")
+        return dict(future.result())
+
+    try:
+        plan = _request_query_plan(build_user_message(schema, user_question))
+    except BaseException as e:
+        # Also on KeyboardInterrupt etc., or waiters would block forever
+        with _IN_FLIGHT_LOCK:
+            del _IN_FLIGHT[key]
+        future.set_exception(e)
+        raise
+
+    with _IN_FLIGHT_LOCK:
+        _PLAN_CACHE[key] = plan
+        if len(_PLAN_CACHE) > _PLAN_CACHE_MAXSIZE:
+            _PLAN_CACHE.popitem(last=False)
+        del _IN_FLIGHT[key]
+    future.set_result(plan)
+    return dict(plan)
+
+
+def _request_query_plan(user_message, retry=False):
+    logger.info("generate_query_plan: sending prompt to LLM | retry=%s", retry)
 
-    user_prompt = prompt
+    user_prompt = user_message
     if retry:
         user_prompt = (
-            "Return ONLY a valid JSON object with a single key 'sql'. "
+            user_message
+            + "\nReturn ONLY a valid JSON object with a single key 'sql'. "
             "The SQL must be a complete SELECT query on table 'data'. "
-            "End the query with a semicolon.\n\n"
-            + prompt
+            "End the query with a semicolon.\n"
         )
 
-    response = _GROQ_CLIENT.chat.completions.create(
-        model=_GROQ_MODEL,
+    response = _client().chat.completions.create(
+        model=_model(),
         messages=[
-            {"role": "system", "content": system_msg},
+            {"role": "system", "content": SYSTEM_PROMPT},
             {"role": "user", "content": user_prompt}
         ],
         temperature=0
@@ -173,19 +252,19 @@ def generate_query_plan(prompt, retry=False):
 
     # -------- Parse attempt --------
     try:
-        plan = json.loads(content)
+        plan = orjson.loads(content)
         if isinstance(plan, dict) and "sql" in plan:
             return plan
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         pass
 
     # Strip markdown
-    code_block = re.search(r"```(?:sql)?([\s\S]*?)```", content, re.IGNORECASE)
+    code_block = _CODE_BLOCK_RE.search(content)
     if code_block:
         content = code_block.group(1).strip()
 
     # Extract SELECT
-    select_match = re.search(r"(select[\s\S]*)", content, re.IGNORECASE)
+    select_match = _SELECT_RE.search(content)
     if select_match:
         sql = select_match.group(1).strip()
 
@@ -199,7 +278,7 @@ def generate_query_plan(prompt, retry=False):
 
     # -------- Retry once --------
     if not retry:
-        return generate_query_plan(prompt, retry=True)
+        return _request_query_plan(user_message, retry=True)
 
     # -------- Hard fail --------
     raise ValueError(
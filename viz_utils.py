@@ -1,3 +1,6 @@
+import builtins
+from functools import lru_cache
+
 import plotly.express as px
 import plotly.graph_objects as go
 import streamlit as st
@@ -5,28 +8,49 @@ from logger_config import get_logger
 
 logger = get_logger(__name__)
 
+# Shared execution environment for generated code, built once instead of per
+# render. The builtins below are what plotting snippets commonly use; this is
+# not a sandbox (px.__builtins__ still reaches the full builtins).
+_VIZ_BUILTINS = {
+    name: getattr(builtins, name)
+    for name in (
+        "abs", "all", "any", "bool", "dict", "divmod", "enumerate", "filter",
+        "float", "format", "frozenset", "getattr", "hasattr", "int", "isinstance",
+        "iter", "len", "list", "map", "max", "min", "next", "pow", "print",
+        "range", "repr", "reversed", "round", "set", "slice", "sorted", "str",
+        "sum", "tuple", "type", "zip", "Exception", "KeyError", "TypeError",
+        "ValueError",
+    )
+}
+_VIZ_GLOBALS_TEMPLATE = {
+    'px': px,
+    'go': go,
+    '__builtins__': _VIZ_BUILTINS,
+}
+
+
+@lru_cache(maxsize=64)
+def _prepare_viz(viz_code):
+    # Remove import statements for safety (already provided in globals)
+    cleaned = "\n".join(
+        line for line in viz_code.splitlines()
+        if not line.strip().startswith(("import ", "from "))
+    )
+    return cleaned, compile(cleaned, "<viz>", "exec")
+
 
 def execute_visualization(df, viz_code):
     logger.info("Executing visualization code")
     logger.debug("Viz code: %s", viz_code)
 
     try:
-        # Remove import statements for safety (already provided in globals)
-        viz_code = "\n".join(
-            line for line in viz_code.splitlines()
-            if not line.strip().startswith(("import ", "from "))
-        )
+        # Import-stripped source and its code object, cached per snippet
+        viz_code, code = _prepare_viz(viz_code)
 
         # Create execution environment with required modules and data
-        exec_globals = {
-            'df': df,
-            'px': px,
-            'go': go,
-            'fig': None,
-            '__builtins__': __builtins__
-        }
-
-        exec(viz_code, exec_globals)
+        exec_globals = {**_VIZ_GLOBALS_TEMPLATE, 'df': df, 'fig': None}
+
+        exec(code, exec_globals)
 
         fig = exec_globals.get('fig')
 